@@ -0,0 +1,341 @@
+"""JSON-RPC plumbing shared by the hlasm-lsp test harnesses."""
+
+import subprocess
+import io
+import itertools
+import json
+import os
+import queue
+import re
+import sys
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Both serialisers deal in bytes so Content-Length is the encoded body size.
+if orjson is not None:
+    dumps = orjson.dumps
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+    loads = json.loads
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(HARNESS_DIR)
+SERVER = os.path.join(ROOT_DIR, "_build", "default", "bin", "main.exe")
+DATA_DIR = os.path.join(ROOT_DIR, "data")
+MACRO_DIR = os.path.join(ROOT_DIR, "resources", "bixoft-macros")
+
+RESPONSE_TIMEOUT = 10  # seconds
+
+# Server log output is discarded unless DEBUG_SERVER=1, in which case it is
+# echoed to our stderr. Either way nothing is left to fill up the pipe.
+DEBUG_SERVER = os.environ.get("DEBUG_SERVER") == "1"
+
+_next_id = itertools.count(1).__next__
+
+# (uri, line, char) -> serialised hover/completion/definition params
+POSITION_PARAMS = {}
+
+# Queued by the reader thread when it stops, after any real notifications.
+_CLOSED = object()
+
+# Constant envelope prefixes. Method names still go through dumps() so they
+# are escaped like any other string.
+_REQUEST_PREFIX = b'{"jsonrpc":"2.0","id":'
+_NOTIFICATION_PREFIX = b'{"jsonrpc":"2.0","method":'
+
+# Content-Length is the only header the harness needs.
+CL_RE = re.compile(rb"(?i)content-length:\s*(\d+)")
+
+# Scatter-gather write for header + body; not available on Windows.
+_writev = getattr(os, "writev", None)
+
+
+def start_server():
+    """Spawn hlasm-lsp with the repo's data and macro directories."""
+    proc = subprocess.Popen(
+        [SERVER, "--data-dir", DATA_DIR, "--macro-dir", MACRO_DIR],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE if DEBUG_SERVER else subprocess.DEVNULL,
+        bufsize=0,
+    )
+    # Header lines come through readline() on a buffered wrapper rather
+    # than one read(1) syscall per byte on the raw pipe.
+    proc._stdout_buf = io.BufferedReader(proc.stdout, buffer_size=65536)
+    # stdin is unbuffered (bufsize=0), so writing to the fd directly cannot
+    # overtake anything still sitting in a user-space buffer.
+    proc._stdin_fd = proc.stdin.fileno()
+    # Reader-thread state is per process, so a second server in the same run
+    # never sees the first one's responses or notifications.
+    proc._responses = {}                 # id -> response not yet claimed
+    proc._responses_ready = threading.Condition()
+    proc._notifications = queue.Queue()  # notifications in arrival order
+    proc._stdout_closed = False
+    proc._reader_error = None  # exception that stopped the reader thread
+    # Drain stdout continuously so the server never blocks on a full pipe
+    # while we are still writing requests.
+    threading.Thread(target=_drain, args=(proc,), daemon=True).start()
+    if DEBUG_SERVER:
+        threading.Thread(target=_drain_stderr, args=(proc,),
+                         daemon=True).start()
+    return proc
+
+
+def read_message(proc):
+    """Read one JSON-RPC message from the server."""
+    stdout_buf = proc._stdout_buf
+    _readline = stdout_buf.readline
+    length = 0
+    while True:
+        line = _readline()
+        if line == b"":
+            return None
+        if line in (b"\r\n", b"\n"):
+            break
+        m = CL_RE.match(line)
+        if m:
+            length = int(m.group(1))
+    if length <= 0:
+        return None
+    body = stdout_buf.read(length)
+    return loads(body)
+
+
+def _writev_all(fd, chunks):
+    """writev() every chunk to fd, resuming after short writes."""
+    chunks = [memoryview(c) for c in chunks]
+    while chunks:
+        n = _writev(fd, chunks)
+        while chunks and n >= len(chunks[0]):
+            n -= len(chunks[0])
+            chunks.pop(0)
+        if n:
+            chunks[0] = chunks[0][n:]
+
+
+def send_raw(proc, body):
+    """Send an already-serialised JSON-RPC body to the server."""
+    header = f"Content-Length: {len(body)}\r\n\r\n".encode()
+    if _writev is not None:
+        _writev_all(proc._stdin_fd, (header, body))
+    else:
+        proc.stdin.write(header + body)
+
+
+def send_request_raw(proc, rid, method, params=None):
+    """Send a request whose params are already serialised."""
+    parts = [_REQUEST_PREFIX, str(rid).encode(), b',"method":', dumps(method)]
+    if params is not None:
+        parts += (b',"params":', params)
+    parts.append(b"}")
+    send_raw(proc, b"".join(parts))
+
+
+def send_request(proc, rid, method, params=None):
+    send_request_raw(proc, rid, method,
+                     None if params is None else dumps(params))
+
+
+def send_notification(proc, method, params=None):
+    parts = [_NOTIFICATION_PREFIX, dumps(method)]
+    if params is not None:
+        parts += (b',"params":', dumps(params))
+    parts.append(b"}")
+    send_raw(proc, b"".join(parts))
+
+
+def _drain(proc):
+    """Reader thread: dispatch server messages until stdout closes.
+
+    A bad frame stops the thread; the exception is kept on proc for
+    read_response to re-raise in the main thread.
+    """
+    ready = proc._responses_ready
+    try:
+        while True:
+            msg = read_message(proc)
+            if msg is None:
+                return
+            if "id" in msg:
+                with ready:
+                    proc._responses[msg["id"]] = msg
+                    ready.notify_all()
+            else:
+                proc._notifications.put(msg)
+    except Exception as e:
+        proc._reader_error = e
+    finally:
+        with ready:
+            proc._stdout_closed = True
+            ready.notify_all()
+        proc._notifications.put(_CLOSED)
+
+
+def _drain_stderr(proc):
+    """Stderr thread: echo the server's log lines until the pipe closes."""
+    fd = proc.stderr.fileno()
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            return
+        sys.stderr.write(chunk.decode(errors="replace"))
+
+
+def _check_reader(proc):
+    """Re-raise whatever stopped the reader thread, if anything did."""
+    if proc._reader_error is not None:
+        raise proc._reader_error
+
+
+def read_response(proc, expected_id):
+    """Return the response with the expected id, or None on timeout/EOF.
+
+    Re-raises whatever stopped the reader thread.
+    """
+    responses = proc._responses
+    with proc._responses_ready:
+        proc._responses_ready.wait_for(
+            lambda: expected_id in responses or proc._stdout_closed,
+            timeout=RESPONSE_TIMEOUT)
+        if expected_id in responses:
+            return responses.pop(expected_id)
+    _check_reader(proc)
+    return None
+
+
+def read_notification(proc):
+    """Return the oldest unread notification, or None on timeout/EOF.
+
+    Re-raises whatever stopped the reader thread.
+    """
+    try:
+        msg = proc._notifications.get(timeout=RESPONSE_TIMEOUT)
+    except queue.Empty:
+        return None
+    if msg is _CLOSED:
+        # Leave the sentinel for the next caller, too.
+        proc._notifications.put(_CLOSED)
+        _check_reader(proc)
+        return None
+    return msg
+
+
+def req_id():
+    return _next_id()
+
+
+def pipeline(proc, requests):
+    """Send every (method, params) request, then read the responses in order.
+
+    The server answers in arrival order, so independent probes can be sent
+    back to back instead of waiting out each round trip.
+    """
+    rids = []
+    for method, params in requests:
+        rid = req_id()
+        if isinstance(params, bytes):
+            send_request_raw(proc, rid, method, params)
+        else:
+            send_request(proc, rid, method, params)
+        rids.append(rid)
+    return [read_response(proc, rid) for rid in rids]
+
+
+def _position_dict(uri, line, char):
+    return {
+        "textDocument": {"uri": uri},
+        "position": {"line": line, "character": char},
+    }
+
+
+def precompile_positions(uri, positions):
+    """Serialise the params for known (line, char) probes once, up front."""
+    for line, char in positions:
+        POSITION_PARAMS[(uri, line, char)] = dumps(
+            _position_dict(uri, line, char))
+
+
+def position_params(uri, line, char):
+    """Pre-serialised params if precompiled, else a params dict."""
+    params = POSITION_PARAMS.get((uri, line, char))
+    if params is None:
+        params = _position_dict(uri, line, char)
+    return params
+
+
+def hover_request(uri, line, char):
+    return ("textDocument/hover", position_params(uri, line, char))
+
+
+def completion_request(uri, line, char):
+    return ("textDocument/completion", position_params(uri, line, char))
+
+
+def references_request(uri, line, char, include_decl=True):
+    params = _position_dict(uri, line, char)
+    params["context"] = {"includeDeclaration": include_decl}
+    return ("textDocument/references", params)
+
+
+def definition_request(uri, line, char):
+    return ("textDocument/definition", position_params(uri, line, char))
+
+
+def hover_value(resp):
+    """Markdown value of a hover response, or None."""
+    if resp and resp.get("result"):
+        return resp["result"]["contents"]["value"]
+    return None
+
+
+def completion_labels(resp):
+    """Item labels of a completion response."""
+    if resp and resp.get("result") and "items" in resp["result"]:
+        return [it["label"] for it in resp["result"]["items"]]
+    return []
+
+
+def reference_lines(resp):
+    """Sorted start lines of a references response."""
+    if resp and resp.get("result"):
+        return sorted([r["range"]["start"]["line"] for r in resp["result"]])
+    return []
+
+
+def definition_location(resp):
+    """(uri, line) of the first definition location, or None."""
+    if resp and resp.get("result"):
+        locs = resp["result"]
+        if isinstance(locs, list) and len(locs) > 0:
+            return (locs[0]["uri"], locs[0]["range"]["start"]["line"])
+    return None
+
+
+def summarize_diags(diags):
+    """One pass over diagnostics: (sorted lines, {line: [diagnostics]})."""
+    lines = []
+    by_line = {}
+    for d in diags:
+        ln = d["range"]["start"]["line"]
+        lines.append(ln)
+        by_line.setdefault(ln, []).append(d)
+    return sorted(lines), by_line
+
+
+def open_doc(proc, uri, text):
+    """Open a document and consume the diagnostics notification."""
+    send_notification(proc, "textDocument/didOpen", {
+        "textDocument": {
+            "uri": uri,
+            "languageId": "hlasm",
+            "version": 1,
+            "text": text,
+        }
+    })
+    return read_notification(proc)  # diagnostics
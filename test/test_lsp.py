@@ -1,445 +1,410 @@
 #!/usr/bin/env python3
 """Headless test harness for hlasm-lsp."""
 
-import subprocess
-import json
 import sys
 import os
 
+from _lsp_harness import (
+    SERVER, dumps, start_server, send_raw, send_request, send_notification,
+    read_response, read_notification, req_id, open_doc, pipeline,
+    hover_request, completion_request, references_request,
+    definition_request, hover_value, completion_labels, reference_lines,
+    definition_location, precompile_positions, summarize_diags,
+)
+
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-ROOT_DIR = os.path.dirname(SCRIPT_DIR)
-SERVER = os.path.join(ROOT_DIR, "_build", "default", "bin", "main.exe")
-DATA_DIR = os.path.join(ROOT_DIR, "data")
-MACRO_DIR = os.path.join(ROOT_DIR, "resources", "bixoft-macros")
 TEST_FILE = os.path.join(SCRIPT_DIR, "test_register.asm")
 TEST_URI = "file:///test/test_register.asm"
 
+with open(TEST_FILE, "r") as f:
+    TEST_TEXT = f.read()
+
+# The main document is opened once per run; serialise its didOpen up front.
+TEST_DIDOPEN_BYTES = dumps({
+    "jsonrpc": "2.0",
+    "method": "textDocument/didOpen",
+    "params": {
+        "textDocument": {
+            "uri": TEST_URI,
+            "languageId": "hlasm",
+            "version": 1,
+            "text": TEST_TEXT,
+        }
+    },
+})
+
+# Hover, completion and definition probes on the main document.
+precompile_positions(TEST_URI, [
+    (0, 0), (7, 16), (8, 9), (16, 15), (17, 15), (27, 15), (32, 20),
+])
+
 passed = 0
 failed = 0
-next_id = 1
-
-
-def read_message(proc):
-    """Read one JSON-RPC message from the server."""
-    headers = {}
-    guard = 0
-    while guard < 64:
-        guard += 1
-        line = b""
-        while True:
-            c = proc.stdout.read(1)
-            if not c:
-                return None
-            if c == b"\n":
-                break
-            line += c
-        text = line.decode().strip()
-        if text == "":
-            break
-        if ":" in text:
-            key, val = text.split(":", 1)
-            headers[key.strip().lower()] = val.strip()
-    length = int(headers.get("content-length", 0))
-    if length <= 0:
-        return None
-    body = proc.stdout.read(length)
-    return json.loads(body)
-
-
-def send_message(proc, msg):
-    """Send a JSON-RPC message to the server."""
-    body = json.dumps(msg)
-    header = f"Content-Length: {len(body)}\r\n\r\n"
-    proc.stdin.write(header.encode())
-    proc.stdin.write(body.encode())
-    proc.stdin.flush()
-
-
-def send_request(proc, rid, method, params=None):
-    msg = {"jsonrpc": "2.0", "id": rid, "method": method}
-    if params is not None:
-        msg["params"] = params
-    send_message(proc, msg)
-
-
-def send_notification(proc, method, params=None):
-    msg = {"jsonrpc": "2.0", "method": method}
-    if params is not None:
-        msg["params"] = params
-    send_message(proc, msg)
-
-
-def read_response(proc, expected_id):
-    """Read messages until we get the response with the expected id."""
-    guard = 0
-    while guard < 32:
-        guard += 1
-        msg = read_message(proc)
-        if msg is None:
-            return None
-        if "id" in msg and msg["id"] == expected_id:
-            return msg
-    return None
+
+# Output is collected and written in one go at the end; VERBOSE=1 prints
+# each line as it happens instead, which helps when the server hangs.
+VERBOSE = os.environ.get("VERBOSE") == "1"
+_log = []
+
+
+def log(line=""):
+    if VERBOSE:
+        print(line)
+    else:
+        _log.append(line)
+
+
+def flush_log():
+    if _log:
+        sys.stdout.write("\n".join(_log) + "\n")
+        sys.stdout.flush()
+        _log.clear()
 
 
 def check(name, condition, detail=""):
     global passed, failed
     if condition:
-        print(f"  PASS: {name}")
+        log(f"  PASS: {name}")
         passed += 1
     else:
-        print(f"  FAIL: {name} -- {detail}")
+        log(f"  FAIL: {name} -- {detail}")
         failed += 1
 
 
-def req_id():
-    global next_id
-    rid = next_id
-    next_id += 1
-    return rid
-
-
-def hover_at(proc, uri, line, char):
-    """Send hover request, return markdown value or None."""
+def run_initialize(proc):
+    """Handshake and advertised capabilities."""
+    # ============================================================
+    log("=== Initialize ===")
+    # ============================================================
     rid = req_id()
-    send_request(proc, rid, "textDocument/hover", {
-        "textDocument": {"uri": uri},
-        "position": {"line": line, "character": char},
+    send_request(proc, rid, "initialize", {
+        "processId": os.getpid(),
+        "capabilities": {},
+        "rootUri": "file:///test",
     })
     resp = read_response(proc, rid)
-    if resp and resp.get("result"):
-        return resp["result"]["contents"]["value"]
-    return None
-
-
-def complete_at(proc, uri, line, char):
-    """Send completion request, return list of item labels."""
-    rid = req_id()
-    send_request(proc, rid, "textDocument/completion", {
-        "textDocument": {"uri": uri},
-        "position": {"line": line, "character": char},
-    })
-    resp = read_response(proc, rid)
-    if resp and resp.get("result") and "items" in resp["result"]:
-        return [it["label"] for it in resp["result"]["items"]]
-    return []
-
-
-def refs_at(proc, uri, line, char, include_decl=True):
-    """Send references request, return list of line numbers."""
+    check("initialize response received", resp is not None)
+
+    caps = resp["result"]["capabilities"]
+    check("hoverProvider advertised", caps.get("hoverProvider") is True)
+    check("completionProvider advertised", caps.get("completionProvider") is not None)
+    check("definitionProvider advertised", caps.get("definitionProvider") is True)
+    check("referencesProvider advertised", caps.get("referencesProvider") is True)
+
+    send_notification(proc, "initialized", {})
+
+
+def run_diagnostics(proc):
+    """Open test_register.asm and check its diagnostics."""
+    # ============================================================
+    log("\n=== Open Document ===")
+    # ============================================================
+    send_raw(proc, TEST_DIDOPEN_BYTES)
+    diag_msg = read_notification(proc)  # diagnostics
+    check("diagnostics published",
+          diag_msg is not None
+          and diag_msg.get("method") == "textDocument/publishDiagnostics")
+
+    # ============================================================
+    log("\n=== Diagnostics ===")
+    # ============================================================
+    # test_register.asm lines (0-indexed):
+    #   22: "         LE    WORK,=E'1.0'"  -> WORK is general, LE wants float
+    #   23: "         LA    FPR,0"          -> FPR is float, LA wants general/address
+    diags = diag_msg["params"]["diagnostics"]
+    check("exactly 2 diagnostics", len(diags) == 2,
+          f"got {len(diags)}")
+
+    diag_lines, diag_by_line = summarize_diags(diags)
+    check("diagnostic on line 22 (LE WORK)", 22 in diag_lines,
+          f"lines: {diag_lines}")
+    check("diagnostic on line 23 (LA FPR)", 23 in diag_lines,
+          f"lines: {diag_lines}")
+
+    # Check messages
+    for d in diag_by_line.get(22, []):
+        msg = d["message"]
+        msg_l = msg.lower()
+        check("line 22: warns about general in float instr",
+              "general" in msg_l and "float" in msg_l,
+              f"msg: {msg}")
+    for d in diag_by_line.get(23, []):
+        msg = d["message"]
+        msg_l = msg.lower()
+        check("line 23: warns about float in address instr",
+              "float" in msg_l,
+              f"msg: {msg}")
+
+    # Check severity (should be warnings, not errors)
+    for d in diags:
+        check(f"line {d['range']['start']['line']} is a warning",
+              d["severity"] == 2,  # 2 = Warning in LSP
+              f"got severity: {d['severity']}")
+
+
+def run_hover(proc):
+    """Hover on macros, registers and control block fields."""
+    cb_uri = "file:///test/cb_test.asm"
+    cb_text = "         L     R5,TCBTID\n"
+    open_doc(proc, cb_uri, cb_text)
+    hovers = pipeline(proc, [
+        hover_request(TEST_URI, 8, 9),
+        hover_request(TEST_URI, 7, 16),
+        hover_request(TEST_URI, 16, 15),
+        # TCBTID starts at char 18
+        hover_request(cb_uri, 0, 18),
+        hover_request(TEST_URI, 0, 0),
+    ])
+
+    # ============================================================
+    log("\n=== Hover: macro (EQUREG) ===")
+    # ============================================================
+    # Line 8, char 9: "WORK     EQUREG R3,G"
+    md = hover_value(hovers[0])
+    check("hover returns content", md is not None)
+    check("hover mentions EQUREG", md is not None and "EQUREG" in md)
+    check("hover has description",
+          md is not None and "type" in md.lower())
+
+    # ============================================================
+    log("\n=== Hover: bare register (R12) ===")
+    # ============================================================
+    # Line 7, char 16: "BASE     EQUREG R12,A"
+    md = hover_value(hovers[1])
+    check("hover returns content", md is not None)
+    check("hover shows R12 info",
+          md is not None and "R12" in md)
+    check("hover mentions base register",
+          md is not None and "Base register" in md)
+
+    # ============================================================
+    log("\n=== Hover: EQUREG register (BASE) ===")
+    # ============================================================
+    # Line 16, char 15: "         LA    BASE,0"
+    md = hover_value(hovers[2])
+    check("hover returns content", md is not None)
+    check("hover shows EQUREG info",
+          md is not None and "EQUREG" in md)
+    check("hover shows Address type",
+          md is not None and "Address" in md)
+    check("hover shows register number",
+          md is not None and "R12" in md)
+
+    # ============================================================
+    log("\n=== Hover: control block field (TCBTID) ===")
+    # ============================================================
+    md = hover_value(hovers[3])
+    check("hover returns content", md is not None)
+    check("hover shows field name",
+          md is not None and "TCBTID" in md)
+    check("hover shows control block (TCB)",
+          md is not None and "TCB" in md)
+
+    # ============================================================
+    log("\n=== Hover: no result on whitespace ===")
+    # ============================================================
+    md = hover_value(hovers[4])
+    check("hover on comment returns nothing", md is None)
+
+
+def run_completion(proc):
+    """Completion at instruction and prefix positions."""
+    # Open a doc with partial text "EQU" to test prefix matching
+    pfx_uri = "file:///test/pfx_test.asm"
+    pfx_text = "         EQU\n"
+    open_doc(proc, pfx_uri, pfx_text)
+    # ...and one with "IF" to check macros are offered
+    mac_uri = "file:///test/mac_test.asm"
+    mac_text = "         IF\n"
+    open_doc(proc, mac_uri, mac_text)
+    completions = pipeline(proc, [
+        completion_request(TEST_URI, 17, 15),
+        # char 11 = 'U' in EQU
+        completion_request(pfx_uri, 0, 11),
+        completion_request(mac_uri, 0, 10),
+    ])
+
+    # ============================================================
+    log("\n=== Completion: at instruction position ===")
+    # ============================================================
+    # Line 17, char 15: "         LR    WORK,R2"
+    #                                 ^ on WORK, should get completions
+    items = completion_labels(completions[0])
+    check("completion returns items", len(items) > 0,
+          f"got {len(items)}")
+    check("completion includes WORK label",
+          "WORK" in items, f"not in {items[:10]}")
+
+    # ============================================================
+    log("\n=== Completion: prefix filtering ===")
+    # ============================================================
+    items = completion_labels(completions[1])
+    check("prefix 'EQU' returns results", len(items) > 0)
+    check("EQUREG in prefix results",
+          "EQUREG" in items, f"items: {items[:10]}")
+    check("EQU in prefix results",
+          "EQU" in items, f"items: {items[:10]}")
+    # Make sure non-matching items are filtered
+    check("non-matching items filtered out",
+          "LA" not in items and "LR" not in items,
+          f"found LA or LR in: {items[:10]}")
+
+    # ============================================================
+    log("\n=== Completion: includes macros ===")
+    # ============================================================
+    items = completion_labels(completions[2])
+    check("IF prefix returns results", len(items) > 0)
+    check("IF macro in results",
+          "IF" in items, f"items: {items[:10]}")
+
+
+def run_references(proc):
+    """References to EQUREG symbols and labels."""
+    refs = pipeline(proc, [
+        references_request(TEST_URI, 8, 0, include_decl=True),
+        references_request(TEST_URI, 8, 0, include_decl=False),
+        references_request(TEST_URI, 31, 0, include_decl=True),
+        references_request(TEST_URI, 34, 0, include_decl=True),
+    ])
+
+    # ============================================================
+    log("\n=== References: WORK (with declaration) ===")
+    # ============================================================
+    ref_lines = reference_lines(refs[0])
+    check("found 4 references to WORK",
+          len(ref_lines) == 4,
+          f"got {len(ref_lines)}: {ref_lines}")
+    check("includes declaration (line 8)", 8 in ref_lines)
+    check("includes LR usage (line 17)", 17 in ref_lines)
+    check("includes LE usage (line 22)", 22 in ref_lines)
+    check("includes BCT usage (line 32)", 32 in ref_lines)
+
+    # ============================================================
+    log("\n=== References: WORK (without declaration) ===")
+    # ============================================================
+    ref_lines = reference_lines(refs[1])
+    check("found 3 references (no declaration)",
+          len(ref_lines) == 3,
+          f"got {len(ref_lines)}: {ref_lines}")
+    check("declaration NOT included", 8 not in ref_lines)
+
+    # ============================================================
+    log("\n=== References: LOOP label ===")
+    # ============================================================
+    ref_lines = reference_lines(refs[2])
+    check("found 2 references to LOOP",
+          len(ref_lines) == 2,
+          f"got {len(ref_lines)}: {ref_lines}")
+
+    # ============================================================
+    log("\n=== References: EXIT label ===")
+    # ============================================================
+    ref_lines = reference_lines(refs[3])
+    check("found 2 references to EXIT",
+          len(ref_lines) == 2,
+          f"got {len(ref_lines)}: {ref_lines}")
+
+
+def run_definition(proc):
+    """Go-to-definition for macros, labels and registers."""
+    defns = pipeline(proc, [
+        definition_request(TEST_URI, 8, 9),
+        # char 20 in "         BCT   WORK,LOOP"
+        definition_request(TEST_URI, 32, 20),
+        definition_request(TEST_URI, 16, 15),
+        # Line 27: "         LR    MYSTERY,R5" -> MYSTERY is undeclared
+        definition_request(TEST_URI, 27, 15),
+    ])
+
+    # ============================================================
+    log("\n=== Definition: EQUREG macro -> .mac file ===")
+    # ============================================================
+    result = definition_location(defns[0])
+    check("definition returned", result is not None)
+    if result:
+        check("points to EQUREG.mac",
+              "EQUREG" in result[0] and ".mac" in result[0],
+              f"got: {result[0]}")
+
+    # ============================================================
+    log("\n=== Definition: LOOP label ===")
+    # ============================================================
+    result = definition_location(defns[1])
+    check("definition returned", result is not None)
+    if result:
+        check("points to line 31", result[1] == 31,
+              f"got line: {result[1]}")
+
+    # ============================================================
+    log("\n=== Definition: BASE register ===")
+    # ============================================================
+    result = definition_location(defns[2])
+    check("definition returned", result is not None)
+    if result:
+        check("points to line 7", result[1] == 7,
+              f"got line: {result[1]}")
+
+    # ============================================================
+    log("\n=== Definition: unknown symbol returns null ===")
+    # ============================================================
+    result = definition_location(defns[3])
+    check("no definition for unknown symbol", result is None,
+          f"got: {result}")
+
+
+def run_shutdown(proc):
+    """Shutdown request and clean exit."""
+    # ============================================================
+    log("\n=== Shutdown ===")
+    # ============================================================
     rid = req_id()
-    send_request(proc, rid, "textDocument/references", {
-        "textDocument": {"uri": uri},
-        "position": {"line": line, "character": char},
-        "context": {"includeDeclaration": include_decl},
-    })
+    send_request(proc, rid, "shutdown")
     resp = read_response(proc, rid)
-    if resp and resp.get("result"):
-        return sorted([r["range"]["start"]["line"] for r in resp["result"]])
-    return []
+    check("shutdown acknowledged", resp is not None)
 
+    send_notification(proc, "exit")
+    proc.wait(timeout=5)
+    check("server exited cleanly", proc.returncode == 0,
+          f"exit code: {proc.returncode}")
 
-def defn_at(proc, uri, line, char):
-    """Send definition request, return (uri, line) or None."""
-    rid = req_id()
-    send_request(proc, rid, "textDocument/definition", {
-        "textDocument": {"uri": uri},
-        "position": {"line": line, "character": char},
-    })
-    resp = read_response(proc, rid)
-    if resp and resp.get("result"):
-        locs = resp["result"]
-        if isinstance(locs, list) and len(locs) > 0:
-            return (locs[0]["uri"], locs[0]["range"]["start"]["line"])
-    return None
 
-
-def open_doc(proc, uri, text):
-    """Open a document and consume the diagnostics notification."""
-    send_notification(proc, "textDocument/didOpen", {
-        "textDocument": {
-            "uri": uri,
-            "languageId": "hlasm",
-            "version": 1,
-            "text": text,
-        }
-    })
-    return read_message(proc)  # diagnostics
+# Suites share one server and run in order: later suites probe the
+# documents opened by earlier ones.
+SUITES = [
+    run_diagnostics,
+    run_hover,
+    run_completion,
+    run_references,
+    run_definition,
+]
 
 
 def main():
-    global passed, failed
+    global failed
 
     if not os.path.exists(SERVER):
         print(f"Server not found at {SERVER}")
         print("Run: opam exec -- dune build")
         return 1
 
-    with open(TEST_FILE, "r") as f:
-        test_text = f.read()
-
-    proc = subprocess.Popen(
-        [SERVER, "--data-dir", DATA_DIR, "--macro-dir", MACRO_DIR],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        bufsize=0,
-    )
+    proc = start_server()
 
     try:
-        # ============================================================
-        print("=== Initialize ===")
-        # ============================================================
-        rid = req_id()
-        send_request(proc, rid, "initialize", {
-            "processId": os.getpid(),
-            "capabilities": {},
-            "rootUri": "file:///test",
-        })
-        resp = read_response(proc, rid)
-        check("initialize response received", resp is not None)
-
-        caps = resp["result"]["capabilities"]
-        check("hoverProvider advertised", caps.get("hoverProvider") is True)
-        check("completionProvider advertised", caps.get("completionProvider") is not None)
-        check("definitionProvider advertised", caps.get("definitionProvider") is True)
-        check("referencesProvider advertised", caps.get("referencesProvider") is True)
-
-        send_notification(proc, "initialized", {})
-
-        # ============================================================
-        print("\n=== Open Document ===")
-        # ============================================================
-        diag_msg = open_doc(proc, TEST_URI, test_text)
-        check("diagnostics published",
-              diag_msg is not None
-              and diag_msg.get("method") == "textDocument/publishDiagnostics")
-
-        # ============================================================
-        print("\n=== Diagnostics ===")
-        # ============================================================
-        # test_register.asm lines (0-indexed):
-        #   22: "         LE    WORK,=E'1.0'"  -> WORK is general, LE wants float
-        #   23: "         LA    FPR,0"          -> FPR is float, LA wants general/address
-        diags = diag_msg["params"]["diagnostics"]
-        check("exactly 2 diagnostics", len(diags) == 2,
-              f"got {len(diags)}")
-
-        diag_lines = sorted([d["range"]["start"]["line"] for d in diags])
-        check("diagnostic on line 22 (LE WORK)", 22 in diag_lines,
-              f"lines: {diag_lines}")
-        check("diagnostic on line 23 (LA FPR)", 23 in diag_lines,
-              f"lines: {diag_lines}")
-
-        # Check messages
-        for d in diags:
-            msg = d["message"]
-            if d["range"]["start"]["line"] == 22:
-                check("line 22: warns about general in float instr",
-                      "general" in msg.lower() and "float" in msg.lower(),
-                      f"msg: {msg}")
-            elif d["range"]["start"]["line"] == 23:
-                check("line 23: warns about float in address instr",
-                      "float" in msg.lower(),
-                      f"msg: {msg}")
-
-        # Check severity (should be warnings, not errors)
-        for d in diags:
-            check(f"line {d['range']['start']['line']} is a warning",
-                  d["severity"] == 2,  # 2 = Warning in LSP
-                  f"got severity: {d['severity']}")
-
-        # ============================================================
-        print("\n=== Hover: macro (EQUREG) ===")
-        # ============================================================
-        # Line 8, char 9: "WORK     EQUREG R3,G"
-        md = hover_at(proc, TEST_URI, 8, 9)
-        check("hover returns content", md is not None)
-        check("hover mentions EQUREG", md is not None and "EQUREG" in md)
-        check("hover has description",
-              md is not None and "type" in md.lower())
-
-        # ============================================================
-        print("\n=== Hover: bare register (R12) ===")
-        # ============================================================
-        # Line 7, char 16: "BASE     EQUREG R12,A"
-        md = hover_at(proc, TEST_URI, 7, 16)
-        check("hover returns content", md is not None)
-        check("hover shows R12 info",
-              md is not None and "R12" in md)
-        check("hover mentions base register",
-              md is not None and "Base register" in md)
-
-        # ============================================================
-        print("\n=== Hover: EQUREG register (BASE) ===")
-        # ============================================================
-        # Line 16, char 15: "         LA    BASE,0"
-        md = hover_at(proc, TEST_URI, 16, 15)
-        check("hover returns content", md is not None)
-        check("hover shows EQUREG info",
-              md is not None and "EQUREG" in md)
-        check("hover shows Address type",
-              md is not None and "Address" in md)
-        check("hover shows register number",
-              md is not None and "R12" in md)
-
-        # ============================================================
-        print("\n=== Hover: control block field (TCBTID) ===")
-        # ============================================================
-        cb_uri = "file:///test/cb_test.asm"
-        cb_text = "         L     R5,TCBTID\n"
-        open_doc(proc, cb_uri, cb_text)
-        # TCBTID starts at char 18
-        md = hover_at(proc, cb_uri, 0, 18)
-        check("hover returns content", md is not None)
-        check("hover shows field name",
-              md is not None and "TCBTID" in md)
-        check("hover shows control block (TCB)",
-              md is not None and "TCB" in md)
-
-        # ============================================================
-        print("\n=== Hover: no result on whitespace ===")
-        # ============================================================
-        md = hover_at(proc, TEST_URI, 0, 0)
-        check("hover on comment returns nothing", md is None)
-
-        # ============================================================
-        print("\n=== Completion: at instruction position ===")
-        # ============================================================
-        # Line 17, char 15: "         LR    WORK,R2"
-        #                                 ^ on WORK, should get completions
-        items = complete_at(proc, TEST_URI, 17, 15)
-        check("completion returns items", len(items) > 0,
-              f"got {len(items)}")
-        check("completion includes WORK label",
-              "WORK" in items, f"not in {items[:10]}")
-
-        # ============================================================
-        print("\n=== Completion: prefix filtering ===")
-        # ============================================================
-        # Open a doc with partial text "EQU" to test prefix matching
-        pfx_uri = "file:///test/pfx_test.asm"
-        pfx_text = "         EQU\n"
-        open_doc(proc, pfx_uri, pfx_text)
-        # char 11 = 'U' in EQU
-        items = complete_at(proc, pfx_uri, 0, 11)
-        check("prefix 'EQU' returns results", len(items) > 0)
-        check("EQUREG in prefix results",
-              "EQUREG" in items, f"items: {items[:10]}")
-        check("EQU in prefix results",
-              "EQU" in items, f"items: {items[:10]}")
-        # Make sure non-matching items are filtered
-        check("non-matching items filtered out",
-              "LA" not in items and "LR" not in items,
-              f"found LA or LR in: {items[:10]}")
-
-        # ============================================================
-        print("\n=== Completion: includes macros ===")
-        # ============================================================
-        mac_uri = "file:///test/mac_test.asm"
-        mac_text = "         IF\n"
-        open_doc(proc, mac_uri, mac_text)
-        items = complete_at(proc, mac_uri, 0, 10)
-        check("IF prefix returns results", len(items) > 0)
-        check("IF macro in results",
-              "IF" in items, f"items: {items[:10]}")
-
-        # ============================================================
-        print("\n=== References: WORK (with declaration) ===")
-        # ============================================================
-        ref_lines = refs_at(proc, TEST_URI, 8, 0, include_decl=True)
-        check("found 4 references to WORK",
-              len(ref_lines) == 4,
-              f"got {len(ref_lines)}: {ref_lines}")
-        check("includes declaration (line 8)", 8 in ref_lines)
-        check("includes LR usage (line 17)", 17 in ref_lines)
-        check("includes LE usage (line 22)", 22 in ref_lines)
-        check("includes BCT usage (line 32)", 32 in ref_lines)
-
-        # ============================================================
-        print("\n=== References: WORK (without declaration) ===")
-        # ============================================================
-        ref_lines = refs_at(proc, TEST_URI, 8, 0, include_decl=False)
-        check("found 3 references (no declaration)",
-              len(ref_lines) == 3,
-              f"got {len(ref_lines)}: {ref_lines}")
-        check("declaration NOT included", 8 not in ref_lines)
-
-        # ============================================================
-        print("\n=== References: LOOP label ===")
-        # ============================================================
-        ref_lines = refs_at(proc, TEST_URI, 31, 0, include_decl=True)
-        check("found 2 references to LOOP",
-              len(ref_lines) == 2,
-              f"got {len(ref_lines)}: {ref_lines}")
-
-        # ============================================================
-        print("\n=== References: EXIT label ===")
-        # ============================================================
-        ref_lines = refs_at(proc, TEST_URI, 34, 0, include_decl=True)
-        check("found 2 references to EXIT",
-              len(ref_lines) == 2,
-              f"got {len(ref_lines)}: {ref_lines}")
-
-        # ============================================================
-        print("\n=== Definition: EQUREG macro -> .mac file ===")
-        # ============================================================
-        result = defn_at(proc, TEST_URI, 8, 9)
-        check("definition returned", result is not None)
-        if result:
-            check("points to EQUREG.mac",
-                  "EQUREG" in result[0] and ".mac" in result[0],
-                  f"got: {result[0]}")
-
-        # ============================================================
-        print("\n=== Definition: LOOP label ===")
-        # ============================================================
-        # char 20 in "         BCT   WORK,LOOP"
-        result = defn_at(proc, TEST_URI, 32, 20)
-        check("definition returned", result is not None)
-        if result:
-            check("points to line 31", result[1] == 31,
-                  f"got line: {result[1]}")
-
-        # ============================================================
-        print("\n=== Definition: BASE register ===")
-        # ============================================================
-        result = defn_at(proc, TEST_URI, 16, 15)
-        check("definition returned", result is not None)
-        if result:
-            check("points to line 7", result[1] == 7,
-                  f"got line: {result[1]}")
-
-        # ============================================================
-        print("\n=== Definition: unknown symbol returns null ===")
-        # ============================================================
-        result = defn_at(proc, TEST_URI, 27, 15)
-        # Line 27: "         LR    MYSTERY,R5" -> MYSTERY is undeclared
-        check("no definition for unknown symbol", result is None,
-              f"got: {result}")
-
-        # ============================================================
-        print("\n=== Shutdown ===")
-        # ============================================================
-        rid = req_id()
-        send_request(proc, rid, "shutdown")
-        resp = read_response(proc, rid)
-        check("shutdown acknowledged", resp is not None)
-
-        send_notification(proc, "exit")
-        proc.wait(timeout=5)
-        check("server exited cleanly", proc.returncode == 0,
-              f"exit code: {proc.returncode}")
-
+        run_initialize(proc)
+        for suite in SUITES:
+            suite(proc)
+        run_shutdown(proc)
     except Exception as e:
+        flush_log()
         print(f"\n  ERROR: {e}")
         import traceback
         traceback.print_exc()
         failed += 1
         proc.kill()
 
-    print(f"\n{'='*50}")
-    print(f"Results: {passed} passed, {failed} failed")
+    log(f"\n{'='*50}")
+    log(f"Results: {passed} passed, {failed} failed")
+    flush_log()
     return 0 if failed == 0 else 1
 
 